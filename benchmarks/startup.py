@@ -0,0 +1,118 @@
+#!/usr/bin/python
+"""
+Measure the startup cost of the modules: import time and peak RSS.
+
+Every module is loaded in a fresh interpreter, the same way Ansible runs it on a host, but without calling main(). The
+SDK the module connects with is imported afterwards, so the output shows both what every run pays up front and what
+is deferred until a connection is made.
+
+Requires ansible (and boto/boto3 for the "sdk" columns) in the python that runs it.
+
+Usage:
+    python benchmarks/startup.py [--runs N] [--json] [module ...]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The SDK each module imports when it connects
+MODULES = {
+    'cat_start_stop': 'boto.ec2',
+    'cat_create_snapshot': 'boto.ec2',
+    'cat_prune_snapshot': 'boto.ec2',
+    'kms_decrypt': 'boto3',
+}
+
+# Runs in the child interpreter. Prints a JSON dict with the timings (in ms) and peak RSS (in KiB).
+PROBE = '''
+import importlib, json, os, resource, sys, time
+
+def load_source(name, path):
+    try:
+        import importlib.util
+    except ImportError:  # python 2
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def rss():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss  # bytes on macOS, KiB on Linux
+
+root, name, sdk = sys.argv[1:4]
+result = {'baseline_rss': rss()}
+
+start = time.time()
+import ansible.module_utils
+for filename in sorted(os.listdir(root + '/module_utils')):
+    if filename.endswith('.py'):
+        load_source('ansible.module_utils.' + filename[:-3], root + '/module_utils/' + filename)
+load_source('startup_' + name, root + '/' + name + '.py')
+result['import_ms'] = (time.time() - start) * 1000
+result['import_rss'] = rss()
+
+start = time.time()
+try:
+    importlib.import_module(sdk)
+    result['sdk_ms'] = (time.time() - start) * 1000
+    result['sdk_rss'] = rss()
+except ImportError:
+    result['sdk_ms'] = result['sdk_rss'] = None
+
+print(json.dumps(result))
+'''
+
+
+def probe(name, python):
+    output = subprocess.check_output([python, '-c', PROBE, ROOT, name, MODULES[name]])
+    return json.loads(output.decode('utf-8'))
+
+
+def best(results, key):
+    values = [result[key] for result in results if result[key] is not None]
+    return min(values) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import time and peak RSS of the modules')
+    parser.add_argument('modules', nargs='*', default=sorted(MODULES), help='modules to measure (default: all)')
+    parser.add_argument('--runs', type=int, default=5, help='runs per module, the best one is reported')
+    parser.add_argument('--python', default=sys.executable, help='interpreter to run the modules with')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    report = {}
+    for name in args.modules:
+        if name not in MODULES:
+            parser.error('unknown module %s' % name)
+        results = [probe(name, args.python) for _ in range(args.runs)]
+        report[name] = dict((key, best(results, key)) for key in results[0])
+
+    if args.json:
+        print(json.dumps(report, indent=4, sort_keys=True))
+        return
+
+    row = '%-20s %10s %14s %10s %14s'
+    print(row % ('module', 'import ms', 'import rss KiB', 'sdk ms', 'sdk rss KiB'))
+    for name in args.modules:
+        result = report[name]
+        print(row % (
+            name,
+            '%.1f' % result['import_ms'],
+            result['import_rss'],
+            '-' if result['sdk_ms'] is None else '%.1f' % result['sdk_ms'],
+            '-' if result['sdk_rss'] is None else result['sdk_rss'],
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -44,6 +44,19 @@ options:
       - The maximum number of minutes after the defined time that the action should still be triggered.
     required: false
     default: 10
+  save_plan:
+    description:
+      - Only in check mode. Path of a file where the actions of this run are saved, so apply_plan can execute them
+        later without discovering all the instances and snapshots again.
+    required: false
+    default: null
+  apply_plan:
+    description:
+      - Path of a plan saved with save_plan. Only the resources in the plan are checked, and the module fails if one of
+        them changed since the plan was made. A plan expires when a normal run would no longer trigger one of its
+        snapshots, so the grace period after the oldest trigger time in the plan.
+    required: false
+    default: null
 '''
 
 EXAMPLES = '''
@@ -54,49 +67,38 @@ EXAMPLES = '''
 - cat_create_snapshot:
     tag: CAT
     grace: 10
+
+# Plan in check mode, review, and apply the plan
+- cat_create_snapshot:
+    tag: CAT
+    save_plan: /tmp/cat_create_snapshot.plan
+  check_mode: yes
+- cat_create_snapshot:
+    tag: CAT
+    apply_plan: /tmp/cat_create_snapshot.plan
 '''
 
 import datetime
+import json
 
-try:
-    import boto.ec2
-except ImportError:
-    print "failed=True msg='boto required for this module'"
-    sys.exit(1)
-
-AUTOMATION_TAG = 'CAT'
-GRACE_MINUTES = 10
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.cat import AUTOMATION_TAG, GRACE_MINUTES, PLAN_STRING, cat_argument_spec, \
+    describe_in_batches, ec2_connect, grace_minutes, load_plan, plan_argument_spec, plan_paths, save_plan, \
+    tag_fingerprint, trigger_times
 
+PLAN_ITEM_KEYS = {
+    'create': {
+        'instance_id': PLAN_STRING,
+        'volume_id': PLAN_STRING,
+        'device': PLAN_STRING,
+        'description': PLAN_STRING,
+        'tag': PLAN_STRING,
+    },
+}
 
-def main():
-    # Output variables
-    changed = False
-    created_snapshots = []
-
-    # Input
-    argument_spec = ec2_argument_spec()
-    argument_spec.update(dict(
-        tag=dict(required=False, default=AUTOMATION_TAG),
-        grace=dict(required=False, default=GRACE_MINUTES, )
-    ))
-    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=True)
-    automation_tag = module.params.get('tag', AUTOMATION_TAG)
-    grace_minutes = module.params.get('grace', GRACE_MINUTES)
-    if grace_minutes.isdigit():
-        grace_minutes = int(grace_minutes)
-    else:
-        module.fail_json(msg='"grace" should be an integer value')
-
-
-    # Get all the times of the actions we should trigger
-    now = datetime.datetime.utcnow()
-    times = []
-    for minute in range(0, grace_minutes):
-        action_time = now - datetime.timedelta(minutes=minute)
-        times.append(action_time)
 
+def find_volumes(conn, automation_tag, times):
     # Get all the snapshots and instances with an automation tag
-    conn = ec2_connect(module)
     filters = {
         'tag-key': automation_tag
     }
@@ -104,10 +106,11 @@ def main():
     snapshots = conn.get_all_snapshots(filters=filters)
     skipped_instances = []
 
-    # We use the description to check if a snapshot exists. Make a list for easy access
-    snapshot_descriptions = map(lambda x: x.description, snapshots)
+    # We use the description to check if a snapshot exists. Make a set for easy access
+    snapshot_descriptions = set(snapshot.description for snapshot in snapshots)
 
     snapshot_configs = {}
+    trigger_datetimes = {}
     for instance in instances:
         # Get the automation tag (should exists, because we filtered)
         automation = json.loads(instance.tags[automation_tag])
@@ -141,24 +144,114 @@ def main():
             skipped_instances.append({ 'instance_id': instance.id, 'reason': 'not the right time'})
             continue  # Try again with the next instance
 
+        trigger_date_string = trigger_datetime.strftime('%Y-%m-%dT%H:%M')
         for dev, mapping_type in instance.block_device_mapping.items():
+            description = 'cat_sn_%(id)s_%(date)s' % {'id': mapping_type.volume_id, 'date': trigger_date_string}
+            if description in snapshot_descriptions:
+                continue
+
             snapshot_config = {
                 'instance_id': instance.id,
                 'volume_id': mapping_type.volume_id,
                 'device': dev,
-                'time': trigger_datetime,
+                'description': description,
+                'tag': tag_fingerprint(instance, automation_tag),
             }
 
             snapshot_configs[mapping_type.volume_id] = snapshot_config
+            trigger_datetimes[mapping_type.volume_id] = trigger_datetime
+
+    # The plan is only valid while every snapshot in it would still be triggered
+    first_trigger = min(trigger_datetimes.values()) if trigger_datetimes else None
+    return list(snapshot_configs.values()), skipped_instances, first_trigger
+
+
+def check_plan(module, conn, automation_tag, path):
+    """
+    Get the volumes to snapshot from a saved plan. Only the instances and snapshots in the plan are described, and the
+    module fails if an instance changed (another automation tag or volume) since the plan was made.
+    """
+    snapshot_configs = load_plan(module, path, 'cat_create_snapshot', PLAN_ITEM_KEYS)['create']
 
-    for volume_id, config in snapshot_configs.items():
-        trigger_date_string = config['time'].strftime('%Y-%m-%dT%H:%M')
+    instances = {}
+    snapshot_descriptions = set()
+    if snapshot_configs:
+        instance_ids = [config['instance_id'] for config in snapshot_configs]
+        for instance in describe_in_batches(conn.get_only_instances, 'instance-id', instance_ids):
+            instances[instance.id] = instance
+        descriptions = [config['description'] for config in snapshot_configs]
+        snapshots = describe_in_batches(conn.get_all_snapshots, 'description', descriptions,
+                                        filters={'tag-key': automation_tag})
+        snapshot_descriptions = set(snapshot.description for snapshot in snapshots)
+
+    planned_configs = []
+    skipped_instances = []
+    stale_instances = []
+    for config in snapshot_configs:
+        instance = instances.get(config['instance_id'])
+        mapping_type = instance.block_device_mapping.get(config['device']) if instance is not None else None
+        if instance is None:
+            stale_instances.append({'instance_id': config['instance_id'], 'reason': 'instance not found'})
+        elif tag_fingerprint(instance, automation_tag) != config['tag']:
+            stale_instances.append({'instance_id': instance.id, 'reason': 'automation tag changed'})
+        elif mapping_type is None or mapping_type.volume_id != config['volume_id']:
+            stale_instances.append({
+                'instance_id': instance.id,
+                'reason': 'volume %s is no longer attached as %s' % (config['volume_id'], config['device'])
+            })
+        elif config['description'] in snapshot_descriptions:
+            skipped_instances.append({
+                'instance_id': instance.id,
+                'volume_id': config['volume_id'],
+                'description': config['description'],
+                'reason': 'snapshot already exists'
+            })
+        else:
+            planned_configs.append(config)
+
+    if stale_instances:
+        module.fail_json(msg='Plan %s is stale, run in check mode again' % path, stale_instances=stale_instances)
+
+    return planned_configs, skipped_instances
+
+
+def main():
+    # Output variables
+    changed = False
+    created_snapshots = []
+
+    # Input
+    argument_spec = cat_argument_spec()
+    argument_spec.update(dict(
+        tag=dict(required=False, default=AUTOMATION_TAG),
+        grace=dict(required=False, default=GRACE_MINUTES, )
+    ))
+    argument_spec.update(plan_argument_spec())
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True,
+        mutually_exclusive=[['save_plan', 'apply_plan']],
+    )
+    automation_tag = module.params.get('tag', AUTOMATION_TAG)
+    grace = grace_minutes(module)
+    save_path, apply_path = plan_paths(module)
+
+    conn = ec2_connect(module)
+    first_trigger = None
+    if apply_path:
+        snapshot_configs, skipped_instances = check_plan(module, conn, automation_tag, apply_path)
+    else:
+        # Get all the times of the actions we should trigger
+        snapshot_configs, skipped_instances, first_trigger = find_volumes(conn, automation_tag, trigger_times(grace))
+
+    if save_path:
+        save_plan(module, save_path, 'cat_create_snapshot', {'create': snapshot_configs}, grace, first_trigger)
+
+    for config in snapshot_configs:
+        volume_id = config['volume_id']
         instance_id = config['instance_id']
         device = config['device']
-        description = 'cat_sn_%(id)s_%(date)s' % {'id': volume_id, 'date': trigger_date_string}
-
-        if description in snapshot_descriptions:
-            continue
+        description = config['description']
 
         snapshot_name = '%(inst)s-%(vol)s-%(date)s' % {
             'inst': instance_id, 'vol': volume_id, 'date': datetime.datetime.utcnow().isoformat()
@@ -181,7 +274,5 @@ def main():
     module.exit_json(changed=changed, snapshots=created_snapshots, skipped_instances=skipped_instances)
 
 
-from ansible.module_utils.basic import *
-from ansible.module_utils.ec2 import *
-
-main()
+if __name__ == '__main__':
+    main()
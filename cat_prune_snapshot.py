@@ -43,6 +43,18 @@ options:
       - The maximum number of minutes after the defined time that the action should still be triggered.
     required: false
     default: 10
+  save_plan:
+    description:
+      - Only in check mode. Path of a file where the actions of this run are saved, so apply_plan can execute them
+        later without discovering all the instances and snapshots again.
+    required: false
+    default: null
+  apply_plan:
+    description:
+      - Path of a plan saved with save_plan. Only the resources in the plan are checked, and the module fails if one of
+        them changed since the plan was made. Plans expire after an hour.
+    required: false
+    default: null
 '''
 
 EXAMPLES = '''
@@ -52,45 +64,53 @@ EXAMPLES = '''
 # Basic example
 - cat_prune_snapshot:
     tag: CAT
+
+# Plan in check mode, review, and apply the plan
+- cat_prune_snapshot:
+    tag: CAT
+    save_plan: /tmp/cat_prune_snapshot.plan
+  check_mode: yes
+- cat_prune_snapshot:
+    tag: CAT
+    apply_plan: /tmp/cat_prune_snapshot.plan
 '''
 
 import datetime
+import json
 
-try:
-    import boto.ec2
-except ImportError:
-    print "failed=True msg='boto required for this module'"
-    sys.exit(1)
-
-# Default values
-AUTOMATION_TAG = 'CAT'
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.cat import AUTOMATION_TAG, PLAN_STRING, PLAN_STRING_LIST, cat_argument_spec, \
+    describe_in_batches, ec2_connect, load_plan, plan_argument_spec, plan_paths, save_plan, tag_fingerprint
 
 # Constants
 DAYS_IN_YEAR = 365.25
 DAYS_IN_WEEK = 7
 DAYS_IN_MONTH = DAYS_IN_YEAR / 12
-
-
-def main():
-    # Output
-    changed = False
+PLAN_VALID_MINUTES = 60
+PLAN_ITEM_KEYS = {
+    'delete': {
+        'snapshot_id': PLAN_STRING,
+        'volume_id': PLAN_STRING,
+        'instance_id': PLAN_STRING,
+        'tag': PLAN_STRING,
+        'instance_tag': PLAN_STRING,
+    },
+    'volumes': {
+        'instance_id': PLAN_STRING,
+        'device': PLAN_STRING,
+        'volume_id': PLAN_STRING,
+        'kept': PLAN_STRING_LIST,
+    },
+}
+
+
+def find_snapshots(conn, automation_tag, now):
     pruned_snapshots = []
     kept_snapshots = []
     skipped_instances = []
-
-    # Input
-    argument_spec = ec2_argument_spec()
-    argument_spec.update(dict(
-        tag=dict(required=False, default=AUTOMATION_TAG),
-    ))
-    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=True)
-    automation_tag = module.params.get('tag', AUTOMATION_TAG)
-
-    # Get the current time
-    now = datetime.datetime.utcnow()
+    volumes = []
 
     # Get all the instances and snapshots with an automation tag
-    conn = ec2_connect(module)
     filters = {
         'tag-key': automation_tag
     }
@@ -185,6 +205,7 @@ def main():
                 finished_keep_times = True
 
             snapshot_amount = len(snapshots)
+            first_kept = len(kept_snapshots)
 
             # Loop through the snapshots, from old to new.
             for i, snapshot in enumerate(snapshots):
@@ -255,14 +276,143 @@ def main():
                         'volume_id': volume_id,
                         'instance_id': instance.id,
                         'reason': reason,
+                        'tag': tag_fingerprint(snapshot, automation_tag),
+                        'instance_tag': tag_fingerprint(instance, automation_tag),
                     })
-                    if not module.check_mode:  # Keep == false, but in check mode
-                        conn.delete_snapshot(snapshot.id)
 
-    module.exit_json(changed=changed, pruned=pruned_snapshots, kept=kept_snapshots, skipped_instances=skipped_instances)
+            # A plan needs the attachment and the kept snapshots, the deletions are only right if they don't change
+            volumes.append({
+                'instance_id': instance.id,
+                'device': dev,
+                'volume_id': volume_id,
+                'kept': [kept['snapshot_id'] for kept in kept_snapshots[first_kept:]],
+            })
+
+    return pruned_snapshots, kept_snapshots, skipped_instances, volumes
+
+
+def check_plan(module, conn, automation_tag, path):
+    """
+    Get the snapshots to delete from a saved plan. Only the snapshots and instances in the plan are described, and the
+    module fails if an automation tag changed, a volume was detached, or a snapshot that was kept is gone since the plan
+    was made.
+    """
+    plan_actions = load_plan(module, path, 'cat_prune_snapshot', PLAN_ITEM_KEYS)
+    planned_snapshots = plan_actions['delete']
+    planned_volumes = plan_actions['volumes']
+
+    snapshots = {}
+    instances = {}
+    if planned_snapshots:
+        snapshot_ids = [item['snapshot_id'] for item in planned_snapshots]
+        snapshot_ids.extend(snapshot_id for volume in planned_volumes for snapshot_id in volume['kept'])
+        for snapshot in describe_in_batches(conn.get_all_snapshots, 'snapshot-id', snapshot_ids):
+            snapshots[snapshot.id] = snapshot
+        instance_ids = [item['instance_id'] for item in planned_snapshots]
+        instance_ids.extend(volume['instance_id'] for volume in planned_volumes)
+        for instance in describe_in_batches(conn.get_only_instances, 'instance-id', instance_ids):
+            instances[instance.id] = instance
+
+    stale_snapshots = []
+    for volume in planned_volumes:
+        instance = instances.get(volume['instance_id'])
+        mapping_type = instance.block_device_mapping.get(volume['device']) if instance is not None else None
+        missing = [snapshot_id for snapshot_id in volume['kept'] if snapshot_id not in snapshots]
+        if instance is None:
+            stale_snapshots.append({
+                'volume_id': volume['volume_id'],
+                'reason': 'instance %s not found' % volume['instance_id']
+            })
+        elif mapping_type is None or mapping_type.volume_id != volume['volume_id']:
+            stale_snapshots.append({
+                'volume_id': volume['volume_id'],
+                'reason': 'volume is no longer attached to %s as %s' % (instance.id, volume['device'])
+            })
+        elif missing:
+            stale_snapshots.append({
+                'volume_id': volume['volume_id'],
+                'reason': 'kept snapshots %s no longer exist' % ', '.join(missing)
+            })
+
+    planned_volume_ids = set(volume['volume_id'] for volume in planned_volumes)
+    pruned_snapshots = []
+    skipped_instances = []
+    for item in planned_snapshots:
+        snapshot = snapshots.get(item['snapshot_id'])
+        instance = instances.get(item['instance_id'])
+        if item['volume_id'] not in planned_volume_ids:
+            stale_snapshots.append({'snapshot_id': item['snapshot_id'], 'reason': 'volume missing from the plan'})
+        elif snapshot is None:
+            skipped_instances.append({
+                'instance_id': item['instance_id'],
+                'snapshot_id': item['snapshot_id'],
+                'reason': 'snapshot already deleted'
+            })
+        elif tag_fingerprint(snapshot, automation_tag) != item['tag']:
+            stale_snapshots.append({'snapshot_id': snapshot.id, 'reason': 'automation tag changed'})
+        elif instance is None:
+            stale_snapshots.append({
+                'snapshot_id': snapshot.id,
+                'reason': 'instance %s not found' % item['instance_id']
+            })
+        elif tag_fingerprint(instance, automation_tag) != item['instance_tag']:
+            stale_snapshots.append({
+                'snapshot_id': snapshot.id,
+                'reason': 'automation tag of instance %s changed' % instance.id
+            })
+        else:
+            pruned_snapshots.append(item)
+
+    if stale_snapshots:
+        module.fail_json(msg='Plan %s is stale, run in check mode again' % path, stale_snapshots=stale_snapshots)
+
+    return pruned_snapshots, skipped_instances
+
 
+def main():
+    # Input
+    argument_spec = cat_argument_spec()
+    argument_spec.update(dict(
+        tag=dict(required=False, default=AUTOMATION_TAG),
+    ))
+    argument_spec.update(plan_argument_spec())
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True,
+        mutually_exclusive=[['save_plan', 'apply_plan']],
+    )
+    automation_tag = module.params.get('tag', AUTOMATION_TAG)
+    save_path, apply_path = plan_paths(module)
+
+    conn = ec2_connect(module)
+    if apply_path:
+        kept_snapshots = []
+        pruned_snapshots, skipped_instances = check_plan(module, conn, automation_tag, apply_path)
+    else:
+        # Get the current time
+        now = datetime.datetime.utcnow()
+        pruned_snapshots, kept_snapshots, skipped_instances, volumes = find_snapshots(conn, automation_tag, now)
+
+    if save_path:
+        pruned_volume_ids = set(snapshot['volume_id'] for snapshot in pruned_snapshots)
+        save_plan(module, save_path, 'cat_prune_snapshot', {
+            'delete': pruned_snapshots,
+            'volumes': [volume for volume in volumes if volume['volume_id'] in pruned_volume_ids],
+        }, PLAN_VALID_MINUTES)
+
+    if not module.check_mode:
+        for snapshot in pruned_snapshots:
+            conn.delete_snapshot(snapshot['snapshot_id'])
+
+    # The fingerprints are only needed in the plan
+    pruned_snapshots = [
+        dict((key, value) for key, value in snapshot.items() if key not in ('tag', 'instance_tag'))
+        for snapshot in pruned_snapshots
+    ]
+
+    changed = bool(pruned_snapshots)
+    module.exit_json(changed=changed, pruned=pruned_snapshots, kept=kept_snapshots, skipped_instances=skipped_instances)
 
-from ansible.module_utils.basic import *
-from ansible.module_utils.ec2 import *
 
-main()
+if __name__ == '__main__':
+    main()
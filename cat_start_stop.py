@@ -44,6 +44,19 @@ options:
       - The maximum number of minutes after the defined time that the action should still be triggered.
     required: false
     default: 10
+  save_plan:
+    description:
+      - Only in check mode. Path of a file where the actions of this run are saved, so apply_plan can execute them
+        later without discovering all the instances and snapshots again.
+    required: false
+    default: null
+  apply_plan:
+    description:
+      - Path of a plan saved with save_plan. Only the resources in the plan are checked, and the module fails if one of
+        them changed since the plan was made. A plan expires when a normal run would no longer trigger one of its
+        actions, so the grace period after the oldest trigger time in the plan.
+    required: false
+    default: null
 '''
 
 EXAMPLES = '''
@@ -54,46 +67,33 @@ EXAMPLES = '''
 - cat_start_stop:
     tag: CAT
     grace: 10
-'''
-
-from datetime import datetime, timedelta
-
-try:
-    import boto.ec2
-except ImportError:
-    print "failed=True msg='boto required for this module'"
-    sys.exit(1)
-
-AUTOMATION_TAG = 'CAT'
-GRACE_MINUTES = 10
 
+# Plan in check mode, review, and apply the plan
+- cat_start_stop:
+    tag: CAT
+    save_plan: /tmp/cat_start_stop.plan
+  check_mode: yes
+- cat_start_stop:
+    tag: CAT
+    apply_plan: /tmp/cat_start_stop.plan
+'''
 
-def main():
-    changed = False
-    argument_spec = ec2_argument_spec()
-    argument_spec.update(dict(
-        tag=dict(required=False, default=AUTOMATION_TAG),
-        grace=dict(required=False, default=GRACE_MINUTES, )
-    ))
+import json
 
-    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=True)
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.cat import AUTOMATION_TAG, GRACE_MINUTES, PLAN_STRING, cat_argument_spec, \
+    describe_in_batches, ec2_connect, grace_minutes, load_plan, plan_argument_spec, plan_paths, save_plan, \
+    tag_fingerprint, trigger_times
 
-    automation_tag = module.params.get('tag', AUTOMATION_TAG)
-    grace_minutes = module.params.get('grace', GRACE_MINUTES)
-    if grace_minutes.isdigit():
-        grace_minutes = int(grace_minutes)
-    else:
-        module.fail_json(msg='"grace" should be an integer value')
+TARGET_STATES = {'start': 'running', 'stop': 'stopped'}
+PLAN_ITEM_KEYS = {
+    'start': {'instance_id': PLAN_STRING, 'state': PLAN_STRING, 'tag': PLAN_STRING},
+    'stop': {'instance_id': PLAN_STRING, 'state': PLAN_STRING, 'tag': PLAN_STRING},
+}
 
-    # Get all the times of the actions we should trigger
-    now = datetime.utcnow()
-    times = []
-    for minute in range(0, grace_minutes):
-        action_time = now - timedelta(minutes=minute)
-        times.append(action_time)
 
+def find_instances(conn, automation_tag, times):
     # Get all the instances with an automation tag
-    conn = ec2_connect(module)
     filters = {
         'tag-key': automation_tag
     }
@@ -114,10 +114,10 @@ def main():
                     if str(action_time.weekday() + 1) not in days:
                         skipped = {'instance_id': instance.id, 'reason': 'No on trigger for this day'}
                     elif '%(h)02d%(m)02d' % {'h': action_time.hour, 'm': action_time.minute} == trigger_time:
-                        start_instances.append(instance)
+                        start_instances.append((instance, action_time))
                         skipped = False
                     elif '%(h)d%(m)02d' % {'h': action_time.hour, 'm': action_time.minute} == trigger_time:
-                        start_instances.append(instance)
+                        start_instances.append((instance, action_time))
                         skipped = False
         except KeyError:
             skipped = {'instance_id': instance.id, 'reason': 'No on key'}
@@ -130,10 +130,10 @@ def main():
                             skipped = {'instance_id': instance.id, 'reason': 'No off trigger for this day'}
                     elif '%(h)02d%(m)02d' % {'h': action_time.hour, 'm': action_time.minute} == trigger_time:
                         if instance.state != 'stopped':
-                            stop_instances.append(instance)
+                            stop_instances.append((instance, action_time))
                             skipped = False
                     elif '%(h)d%(m)02d' % {'h': action_time.hour, 'm': action_time.minute} == trigger_time:
-                        stop_instances.append(instance)
+                        stop_instances.append((instance, action_time))
                         skipped = False
         except KeyError:
             skipped = {'instance_id': instance.id, 'reason': 'No off key'}
@@ -141,28 +141,107 @@ def main():
         if skipped:
             skipped_instances.append(skipped)
 
-    stop_ids = []
-    start_ids = []
-    if stop_instances:  # not empty
-        for instance in stop_instances:
-            if instance.state != 'stopped':
-                changed = True
-                stop_ids.append(instance.id)
-    if start_instances:  # not empty
-        for instance in start_instances:
-            if instance.state != 'running':
-                changed = True
-                start_ids.append(instance.id)
+    # An instance can match more than one trigger time, only keep the first match. A normal run triggers the action
+    # as long as its latest matching time is in the grace period, so remember that time for the plan.
+    actions = {'start': [], 'stop': []}
+    latest_triggers = {}
+    for action, action_instances in (('start', start_instances), ('stop', stop_instances)):
+        for instance, action_time in action_instances:
+            if instance.state == TARGET_STATES[action]:
+                continue
+            if instance not in actions[action]:
+                actions[action].append(instance)
+            key = (action, instance.id)
+            latest_triggers[key] = max(latest_triggers.get(key, action_time), action_time)
+
+    # The plan is only valid while every action in it would still be triggered
+    first_trigger = min(latest_triggers.values()) if latest_triggers else None
+    return actions, skipped_instances, first_trigger
+
+
+def check_plan(module, conn, automation_tag, path):
+    """
+    Get the instances to start and stop from a saved plan. Only the instances in the plan are described, and the module
+    fails if one of them changed (another state or automation tag) since the plan was made.
+    """
+    plan_actions = load_plan(module, path, 'cat_start_stop', PLAN_ITEM_KEYS)
+
+    instance_ids = [item['instance_id'] for action in TARGET_STATES for item in plan_actions[action]]
+    current = {}
+    for instance in describe_in_batches(conn.get_only_instances, 'instance-id', instance_ids):
+        current[instance.id] = instance
+
+    actions = {'start': [], 'stop': []}
+    skipped_instances = []
+    stale_instances = []
+    for action, target_state in TARGET_STATES.items():
+        for item in plan_actions[action]:
+            instance = current.get(item['instance_id'])
+            if instance is None:
+                stale_instances.append({'instance_id': item['instance_id'], 'reason': 'instance not found'})
+            elif tag_fingerprint(instance, automation_tag) != item['tag']:
+                stale_instances.append({'instance_id': instance.id, 'reason': 'automation tag changed'})
+            elif instance.state == target_state:
+                skipped_instances.append({'instance_id': instance.id, 'reason': 'already %s' % target_state})
+            elif instance.state != item['state']:
+                stale_instances.append({
+                    'instance_id': instance.id,
+                    'reason': 'state changed from %s to %s' % (item['state'], instance.state)
+                })
+            else:
+                actions[action].append(instance)
+
+    if stale_instances:
+        module.fail_json(msg='Plan %s is stale, run in check mode again' % path, stale_instances=stale_instances)
+
+    return actions, skipped_instances
+
+
+def main():
+    argument_spec = cat_argument_spec()
+    argument_spec.update(dict(
+        tag=dict(required=False, default=AUTOMATION_TAG),
+        grace=dict(required=False, default=GRACE_MINUTES, )
+    ))
+    argument_spec.update(plan_argument_spec())
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True,
+        mutually_exclusive=[['save_plan', 'apply_plan']],
+    )
+
+    automation_tag = module.params.get('tag', AUTOMATION_TAG)
+    grace = grace_minutes(module)
+    save_path, apply_path = plan_paths(module)
+
+    conn = ec2_connect(module)
+    first_trigger = None
+    if apply_path:
+        actions, skipped_instances = check_plan(module, conn, automation_tag, apply_path)
+    else:
+        # Get all the times of the actions we should trigger
+        actions, skipped_instances, first_trigger = find_instances(conn, automation_tag, trigger_times(grace))
+
+    if save_path:
+        save_plan(module, save_path, 'cat_start_stop', dict(
+            (action, [
+                {'instance_id': instance.id, 'state': instance.state, 'tag': tag_fingerprint(instance, automation_tag)}
+                for instance in instances
+            ]) for action, instances in actions.items()
+        ), grace, first_trigger)
+
+    start_ids = [instance.id for instance in actions['start']]
+    stop_ids = [instance.id for instance in actions['stop']]
 
     if stop_ids and not module.check_mode:
         conn.stop_instances(stop_ids)
     if start_ids and not module.check_mode:
         conn.start_instances(start_ids)
 
+    changed = bool(start_ids or stop_ids)
     module.exit_json(changed=changed, started=start_ids, stopped=stop_ids, skipped_instances=skipped_instances)
 
 
-from ansible.module_utils.basic import *
-from ansible.module_utils.ec2 import *
-
-main()
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,23 @@
 #!/usr/bin/python
-import base64
 
 DOCUMENTATION = '''
 short_description: Decrypt a secret that was generated by KMS
 description:
   - This module decrypts the given secret using AWS KMS, and returns it as the Plaintext property
+  - It can also decrypt envelope encrypted files that are too big for KMS. Only the data key (stored in the header of
+    the file) is decrypted by KMS, the file itself is decrypted locally, chunk by chunk, from src to dest.
 version_added: null
 author: Ben Bridts
 notes:
   - Make sure you read http://docs.aws.amazon.com/kms/latest/developerguide/control-access.html to learn how to restrict
     access to your keys
+  - The envelope file format is described in module_utils/envelope.py. Files that share a data key only need one call to
+    KMS, as long as they are decrypted by the same task (with the files option) within data_key_ttl seconds.
+  - Decrypted files are always written with mode 0600, also when dest already exists, so the plaintext is only
+    readable by the user the module runs as. Change the mode afterwards (for example with the file module) if needed.
 requirements:
   - the boto3 python package
+  - the cryptography python package, to decrypt files
 options:
   aws_secret_key:
     description:
@@ -36,8 +42,30 @@ options:
   secret:
     description:
       - The encrypted string you want to decode
+      - One of secret, src or files is required
+    required: false
+    default: null
+  src:
+    description:
+      - Path of an envelope encrypted file you want to decrypt
     required: false
-    default: CAT
+    default: null
+  dest:
+    description:
+      - Path where the decrypted src is written, with mode 0600. Required together with src.
+    required: false
+    default: null
+  files:
+    description:
+      - List of dictionaries with a src and dest key, to decrypt multiple files in one task
+    required: false
+    default: null
+  data_key_ttl:
+    description:
+      - Number of seconds an unwrapped data key is reused for other files. Set to 0 to decrypt the data key for every
+        file.
+    required: false
+    default: 300
 '''
 
 EXAMPLES = '''
@@ -49,41 +77,127 @@ EXAMPLES = '''
 - name: Show plaintext
   debug: var=result.plaintext
   delegate_to: 127.0.0.1
-'''
 
-import sys
+- name: Decrypt an envelope encrypted file
+  kms_decrypt:
+    src: /tmp/dump.sql.enc
+    dest: /tmp/dump.sql
 
-try:
-    import boto3
-except ImportError:
-    print "failed=True msg='boto3 required for this module'"
-    sys.exit(1)
+- name: Decrypt multiple files, with one KMS call per data key
+  kms_decrypt:
+    files:
+      - src: /tmp/dump.sql.enc
+        dest: /tmp/dump.sql
+      - src: /tmp/media.tar.enc
+        dest: /tmp/media.tar
+'''
 
+import base64
+import os
+import tempfile
 
-def main():
-    argument_spec = ec2_argument_spec()
-    argument_spec.update(dict(
-        secret=dict(required=True),
-    ))
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.cat import boto3_client, cat_argument_spec, require_sdk
+from ansible.module_utils.envelope import DataKeyCache, EnvelopeError, decrypt_stream, read_header
 
-    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=False)
-    secret = module.params.get('secret')
-    secret = base64.decodestring(secret)
+DATA_KEY_TTL = 300
 
-    client = boto3.client('kms')
 
+def kms_decrypt(module, client, ciphertext):
     response = client.decrypt(
-        CiphertextBlob=secret
+        CiphertextBlob=ciphertext
     )
 
     status_code = response['ResponseMetadata']['HTTPStatusCode']
     if status_code != 200:
         module.fail_json(msg='Failed with http status code %s' % status_code)
 
-    module.exit_json(changed=True, plaintext=response['Plaintext'], key_id=response['KeyId'])
+    return response
+
+
+def decrypt_file(cipher, header, src_file, dest):
+    # Write to a temporary file next to dest, so dest is never left half written. mkstemp creates it with mode 0600, and
+    # renaming it within the same directory keeps that mode, so the plaintext is never readable for others. Don't use
+    # module.atomic_move here, it gives the file the permissions of the old dest or the umask before we could tighten
+    # them.
+    dest_dir = os.path.dirname(os.path.abspath(dest))
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.kms_decrypt')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            decrypt_stream(cipher, header, src_file, tmp_file)
+        os.rename(tmp_path, dest)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def decrypt_files(module, client, files):
+    aead = require_sdk(module, 'cryptography.hazmat.primitives.ciphers.aead')
+    invalid_tag = require_sdk(module, 'cryptography.exceptions').InvalidTag
+    botocore_exceptions = require_sdk(module, 'botocore.exceptions')
+    cache = DataKeyCache(module.params.get('data_key_ttl'))
+
+    def unwrap(wrapped_key):
+        response = kms_decrypt(module, client, wrapped_key)
+        return aead.AESGCM(response['Plaintext']), response['KeyId']
+
+    decrypted_files = []
+    for item in files:
+        if not isinstance(item, dict) or not item.get('src') or not item.get('dest'):
+            module.fail_json(msg='Every item in files should have a src and dest key')
+        src = os.path.expanduser(item['src'])
+        dest = os.path.expanduser(item['dest'])
+
+        try:
+            with open(src, 'rb') as src_file:
+                header = read_header(src_file)
+                try:
+                    cipher, key_id = cache.get(header.wrapped_key, unwrap)
+                except (botocore_exceptions.BotoCoreError, botocore_exceptions.ClientError, ValueError) as e:
+                    module.fail_json(msg='Failed to decrypt the data key of %s: %s' % (src, e))
+                decrypt_file(cipher, header, src_file, dest)
+        except invalid_tag:
+            module.fail_json(msg='Failed to decrypt %s, it was modified or encrypted with another key' % src)
+        except EnvelopeError as e:
+            module.fail_json(msg='Failed to decrypt %s: %s' % (src, e))
+        except (IOError, OSError) as e:
+            module.fail_json(msg='Failed to decrypt %s: %s' % (src, e))
+
+        decrypted_files.append({'src': src, 'dest': dest, 'key_id': key_id})
+
+    return decrypted_files, cache.misses
+
 
+def main():
+    argument_spec = cat_argument_spec()
+    argument_spec.update(dict(
+        secret=dict(required=False),
+        src=dict(required=False, type='path'),
+        dest=dict(required=False, type='path'),
+        files=dict(required=False, type='list'),
+        data_key_ttl=dict(required=False, type='int', default=DATA_KEY_TTL),
+    ))
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=False,
+        mutually_exclusive=[['secret', 'src'], ['secret', 'files'], ['src', 'files']],
+        required_together=[['src', 'dest']],
+        required_one_of=[['secret', 'src', 'files']],
+    )
+
+    client = boto3_client(module, 'kms')
+
+    if module.params.get('secret') is None:
+        files = module.params.get('files') or [{'src': module.params.get('src'), 'dest': module.params.get('dest')}]
+        decrypted_files, kms_calls = decrypt_files(module, client, files)
+        module.exit_json(changed=True, files=decrypted_files, kms_calls=kms_calls)
+
+    secret = base64.b64decode(module.params.get('secret'))
+    response = kms_decrypt(module, client, secret)
+
+    module.exit_json(changed=True, plaintext=response['Plaintext'], key_id=response['KeyId'])
 
-from ansible.module_utils.basic import *
-from ansible.module_utils.ec2 import *
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+# Shared code for the Cloudar modules (CAT and KMS).
+#
+# Only the standard library is imported at load time. The AWS SDKs (boto for the CAT modules, boto3 for kms_decrypt)
+# are imported the first time a connection is made, so a module never pays for an SDK it doesn't use.
+
+import datetime
+import hashlib
+import importlib
+import json
+import os
+import tempfile
+
+AUTOMATION_TAG = 'CAT'
+GRACE_MINUTES = 10
+
+# EC2 refuses more values than this in one filter
+EC2_FILTER_LIMIT = 200
+
+PLAN_VERSION = 1
+PLAN_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# The types of the values in the items of a plan
+PLAN_STRING = 'string'
+PLAN_STRING_LIST = 'list of strings'
+
+try:
+    STRING_TYPES = (basestring,)
+except NameError:  # python 3
+    STRING_TYPES = (str,)
+
+
+def cat_argument_spec():
+    """The AWS connection options shared by all modules. Compatible with ec2_argument_spec."""
+    return dict(
+        ec2_url=dict(),
+        aws_secret_key=dict(aliases=['ec2_secret_key', 'secret_key'], no_log=True),
+        aws_access_key=dict(aliases=['ec2_access_key', 'access_key']),
+        validate_certs=dict(default=True, type='bool'),
+        security_token=dict(aliases=['access_token'], no_log=True),
+        region=dict(aliases=['aws_region', 'ec2_region']),
+        profile=dict(),
+    )
+
+
+def require_sdk(module, name):
+    """Import an SDK module on first use, or fail the module if it isn't installed."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        module.fail_json(msg='%s required for this module' % name.split('.')[0])
+
+
+def _from_env(*names):
+    for name in names:
+        if os.environ.get(name):
+            return os.environ[name]
+    return None
+
+
+def aws_connection_info(module):
+    """Get the region and credentials from the module parameters, falling back to the environment."""
+    params = module.params
+
+    region = params.get('region') or _from_env('AWS_REGION', 'AWS_DEFAULT_REGION', 'EC2_REGION')
+    credentials = {
+        'access_key': params.get('aws_access_key') or _from_env('AWS_ACCESS_KEY_ID', 'AWS_ACCESS_KEY',
+                                                                  'EC2_ACCESS_KEY'),
+        'secret_key': params.get('aws_secret_key') or _from_env('AWS_SECRET_ACCESS_KEY', 'AWS_SECRET_KEY',
+                                                                  'EC2_SECRET_KEY'),
+        'security_token': params.get('security_token') or _from_env('AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN',
+                                                                      'EC2_SECURITY_TOKEN'),
+        'profile': params.get('profile'),
+        'validate_certs': params.get('validate_certs', True),
+        'ec2_url': params.get('ec2_url') or _from_env('AWS_URL', 'EC2_URL'),
+    }
+    return region, credentials
+
+
+def ec2_connect(module):
+    """Connect to EC2 with boto. boto is only imported here."""
+    boto = require_sdk(module, 'boto')
+    boto_ec2 = require_sdk(module, 'boto.ec2')
+
+    region, credentials = aws_connection_info(module)
+    if not region:
+        region = boto.config.get('Boto', 'aws_region', boto.config.get('Boto', 'ec2_region'))
+
+    connect_params = {'validate_certs': credentials['validate_certs']}
+    if credentials['access_key']:
+        connect_params['aws_access_key_id'] = credentials['access_key']
+    if credentials['secret_key']:
+        connect_params['aws_secret_access_key'] = credentials['secret_key']
+    if credentials['security_token']:
+        connect_params['security_token'] = credentials['security_token']
+    if credentials['profile']:
+        connect_params['profile_name'] = credentials['profile']
+
+    try:
+        if credentials['ec2_url']:
+            conn = boto.connect_ec2_endpoint(credentials['ec2_url'], **connect_params)
+        elif region:
+            conn = boto_ec2.connect_to_region(region, **connect_params)
+        else:
+            module.fail_json(msg='Either region or ec2_url must be specified')
+    except boto.exception.NoAuthHandlerFound as e:
+        module.fail_json(msg=str(e))
+
+    if conn is None:
+        module.fail_json(msg='Could not connect to EC2 in region %s' % region)
+    return conn
+
+
+def boto3_client(module, service):
+    """Create a boto3 client for service. boto3 is only imported here."""
+    boto3 = require_sdk(module, 'boto3')
+
+    region, credentials = aws_connection_info(module)
+    session = boto3.session.Session(
+        aws_access_key_id=credentials['access_key'],
+        aws_secret_access_key=credentials['secret_key'],
+        aws_session_token=credentials['security_token'],
+        region_name=region,
+        profile_name=credentials['profile'],
+    )
+    return session.client(service, verify=credentials['validate_certs'])
+
+
+def grace_minutes(module):
+    """Get the grace period in minutes, failing the module when it isn't an integer."""
+    grace = str(module.params.get('grace', GRACE_MINUTES))
+    if not grace.isdigit():
+        module.fail_json(msg='"grace" should be an integer value')
+    return int(grace)
+
+
+def trigger_times(grace, now=None):
+    """All the (UTC) minutes in the grace period, newest first. Actions scheduled on one of them should be triggered."""
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return [now - datetime.timedelta(minutes=minute) for minute in range(0, grace)]
+
+
+def describe_in_batches(describe, filter_name, values, filters=None):
+    """
+    Call describe (for example conn.get_only_instances) with filter_name set to values, in batches small enough for
+    EC2, and return all the results. Other filters are added to every batch.
+    """
+    seen = set()
+    unique_values = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            unique_values.append(value)
+
+    results = []
+    for start in range(0, len(unique_values), EC2_FILTER_LIMIT):
+        batch_filters = dict(filters or {})
+        batch_filters[filter_name] = unique_values[start:start + EC2_FILTER_LIMIT]
+        results.extend(describe(filters=batch_filters))
+    return results
+
+
+def plan_argument_spec():
+    """Options to save a plan in check mode, and to apply it later without discovering everything again."""
+    return dict(
+        save_plan=dict(required=False, type='path'),
+        apply_plan=dict(required=False, type='path'),
+    )
+
+
+def plan_paths(module):
+    """Get the save_plan and apply_plan paths, failing the module if save_plan is used outside of check mode."""
+    save_path = module.params.get('save_plan')
+    apply_path = module.params.get('apply_plan')
+    if save_path and not module.check_mode:
+        module.fail_json(msg='"save_plan" can only be used in check mode')
+    return save_path, apply_path
+
+
+def tag_fingerprint(resource, automation_tag):
+    """Short hash of the automation tag of an instance or snapshot, to notice when it changed after planning."""
+    value = resource.tags.get(automation_tag, '')
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()[:12]
+
+
+def save_plan(module, path, name, actions, valid_minutes, valid_from=None):
+    """
+    Write the actions of a check mode run to path, so a later run can apply them. The plan expires valid_minutes after
+    valid_from (the earliest trigger time in the plan), or after now if there is none.
+    """
+    now = datetime.datetime.utcnow()
+    expires = (valid_from or now) + datetime.timedelta(minutes=valid_minutes)
+    plan = {
+        'version': PLAN_VERSION,
+        'module': name,
+        'tag': module.params.get('tag'),
+        'created': now.strftime(PLAN_TIME_FORMAT),
+        'expires': expires.strftime(PLAN_TIME_FORMAT),
+        'actions': actions,
+    }
+
+    # Write to a temporary file first, so an apply never reads a half written plan
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.cat_plan')
+    with os.fdopen(fd, 'w') as tmp_file:
+        json.dump(plan, tmp_file, sort_keys=True, separators=(',', ':'))
+    module.atomic_move(tmp_path, path)
+
+
+def _valid_value(value, value_type):
+    if value_type == PLAN_STRING_LIST:
+        return isinstance(value, list) and all(isinstance(element, STRING_TYPES) for element in value)
+    return isinstance(value, STRING_TYPES)
+
+
+def _valid_actions(actions, item_keys):
+    if not isinstance(actions, dict):
+        return False
+    for action, keys in item_keys.items():
+        items = actions.get(action)
+        if not isinstance(items, list):
+            return False
+        for item in items:
+            if not isinstance(item, dict):
+                return False
+            for key, value_type in keys.items():
+                if key not in item or not _valid_value(item[key], value_type):
+                    return False
+    return True
+
+
+def load_plan(module, path, name, item_keys):
+    """
+    Read a plan written by save_plan and return its actions, failing the module if it can't be applied. item_keys maps
+    every action to the keys each of its items should have, and their type (PLAN_STRING or PLAN_STRING_LIST).
+    """
+    try:
+        with open(path) as plan_file:
+            plan = json.load(plan_file)
+    except (IOError, OSError, ValueError) as e:
+        module.fail_json(msg='Could not read plan %s: %s' % (path, e))
+
+    if not isinstance(plan, dict) or plan.get('version') != PLAN_VERSION:
+        version = plan.get('version') if isinstance(plan, dict) else None
+        module.fail_json(msg='Plan %s has version %s, expected %s' % (path, version, PLAN_VERSION))
+    if plan.get('module') != name:
+        module.fail_json(msg='Plan %s was made by %s, not %s' % (path, plan.get('module'), name))
+    if plan.get('tag') != module.params.get('tag'):
+        module.fail_json(msg='Plan %s was made for tag %s, not %s' % (path, plan.get('tag'), module.params.get('tag')))
+    if datetime.datetime.utcnow().strftime(PLAN_TIME_FORMAT) > plan.get('expires', ''):
+        module.fail_json(msg='Plan %s expired at %s, run in check mode again' % (path, plan.get('expires')))
+    if not _valid_actions(plan.get('actions'), item_keys):
+        module.fail_json(msg='Plan %s is invalid' % path)
+
+    return plan['actions']
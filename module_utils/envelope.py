@@ -0,0 +1,141 @@
+# Envelope encryption for files that are too big for KMS.
+#
+# A file is encrypted with a random AES-256 data key, and that data key is encrypted ("wrapped") with KMS, for example
+# with GenerateDataKey. The wrapped key is stored in the header of the file, so KMS is only needed to unwrap it.
+#
+# File format (all integers are big endian):
+#
+#   magic           4 bytes   'CKE1'
+#   key length      2 bytes
+#   wrapped key     key length bytes, the CiphertextBlob returned by KMS
+#   chunk size      4 bytes
+#   nonce prefix    8 bytes, random per file
+#   chunks          AES-GCM of chunk size plaintext bytes + 16 bytes tag. The last chunk is shorter (it can be empty)
+#
+# Chunk i is encrypted with nonce (nonce prefix + i as 4 bytes) and the header + i + a final flag as associated data,
+# so chunks can't be reordered, swapped between files, or cut off at a chunk boundary without failing authentication.
+#
+# The cipher is passed in (an AESGCM instance from the cryptography package), so this file only needs the standard
+# library to load.
+
+import hashlib
+import os
+import struct
+import time
+from collections import namedtuple
+
+MAGIC = b'CKE1'
+CHUNK_SIZE = 64 * 1024
+# The chunk size comes from the file, cap it so a corrupt file can't make us read gigabytes at once
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 8
+
+EnvelopeHeader = namedtuple('EnvelopeHeader', ['wrapped_key', 'chunk_size', 'nonce_prefix', 'raw'])
+
+
+class EnvelopeError(Exception):
+    pass
+
+
+def _read_exactly(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise EnvelopeError('Unexpected end of file, the envelope header is incomplete')
+    return data
+
+
+def read_header(fileobj):
+    """Read the envelope header from the start of fileobj."""
+    magic = fileobj.read(len(MAGIC))
+    if magic != MAGIC:
+        raise EnvelopeError('Not an envelope encrypted file')
+    key_length = _read_exactly(fileobj, 2)
+    wrapped_key = _read_exactly(fileobj, struct.unpack('>H', key_length)[0])
+    chunk_size = _read_exactly(fileobj, 4)
+    nonce_prefix = _read_exactly(fileobj, NONCE_PREFIX_SIZE)
+
+    raw = magic + key_length + wrapped_key + chunk_size + nonce_prefix
+    chunk_size = struct.unpack('>I', chunk_size)[0]
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise EnvelopeError('Invalid chunk size %s in the envelope header, it should be at most %s'
+                            % (chunk_size, MAX_CHUNK_SIZE))
+    return EnvelopeHeader(wrapped_key, chunk_size, nonce_prefix, raw)
+
+
+def make_header(wrapped_key, chunk_size=CHUNK_SIZE):
+    """Create a header for a new file, with a random nonce prefix."""
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise EnvelopeError('The chunk size should be between 1 and %s' % MAX_CHUNK_SIZE)
+    nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+    raw = MAGIC + struct.pack('>H', len(wrapped_key)) + wrapped_key + struct.pack('>I', chunk_size) + nonce_prefix
+    return EnvelopeHeader(wrapped_key, chunk_size, nonce_prefix, raw)
+
+
+def _chunk_params(header, index, final):
+    if index > 0xFFFFFFFF:
+        raise EnvelopeError('Too many chunks, use a bigger chunk size')
+    nonce = header.nonce_prefix + struct.pack('>I', index)
+    associated_data = header.raw + struct.pack('>IB', index, 1 if final else 0)
+    return nonce, associated_data
+
+
+def encrypt_stream(cipher, header, src, dest):
+    """Encrypt src to dest, chunk by chunk. Only two chunks are kept in memory."""
+    dest.write(header.raw)
+    index = 0
+    chunk = src.read(header.chunk_size)
+    while True:
+        next_chunk = src.read(header.chunk_size)
+        final = not next_chunk
+        nonce, associated_data = _chunk_params(header, index, final)
+        dest.write(cipher.encrypt(nonce, chunk, associated_data))
+        if final:
+            return
+        chunk = next_chunk
+        index += 1
+
+
+def decrypt_stream(cipher, header, src, dest):
+    """Decrypt the chunks after the header from src to dest. Only two chunks are kept in memory.
+
+    The cipher raises (cryptography.exceptions.InvalidTag) when a chunk was tampered with. Whatever was written to dest
+    up to then should be discarded.
+    """
+    encrypted_size = header.chunk_size + TAG_SIZE
+    index = 0
+    chunk = src.read(encrypted_size)
+    while True:
+        if len(chunk) < TAG_SIZE:
+            raise EnvelopeError('Unexpected end of file, the encrypted data is incomplete')
+        next_chunk = src.read(encrypted_size)
+        final = not next_chunk
+        nonce, associated_data = _chunk_params(header, index, final)
+        dest.write(cipher.decrypt(nonce, chunk, associated_data))
+        if final:
+            return
+        chunk = next_chunk
+        index += 1
+
+
+class DataKeyCache(object):
+    """Keep unwrapped data keys for ttl seconds, so files under the same data key need only one KMS call."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.misses = 0
+        self._keys = {}
+
+    def get(self, wrapped_key, unwrap):
+        """Return the cached value for wrapped_key, or call unwrap(wrapped_key) and cache its result."""
+        cache_key = hashlib.sha256(wrapped_key).hexdigest()
+        now = time.time()
+        entry = self._keys.get(cache_key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        value = unwrap(wrapped_key)
+        self.misses += 1
+        if self.ttl > 0:
+            self._keys[cache_key] = (value, now + self.ttl)
+        return value